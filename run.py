@@ -5,19 +5,29 @@
 from __future__ import annotations
 
 import argparse
-import json
+import asyncio
+import contextlib
+import http.client
 import os
 import re
-import subprocess
+import signal
 import sys
 import time
 from pathlib import Path
-from typing import Sequence
-from urllib.error import HTTPError, URLError
-from urllib.request import urlopen
+from typing import Callable, Sequence
 
+try:
+    from orjson import loads as json_loads
+except ImportError:  # orjson ships with apache-flink, but stay usable without it
+    from json import loads as json_loads
 
-JOB_ID_PATTERN = re.compile(r"JobID ([a-f0-9]{32})")
+
+JOB_ID_PATTERN = re.compile(rb"JobID ([a-f0-9]{32})")
+SAVEPOINT_PATH_PATTERN = re.compile(rb"Path:\s+file:(\S+)")
+
+CLUSTER_READY_TIMEOUT = 30
+JOB_RUNNING_TIMEOUT = 30
+TASK_INIT_TIMEOUT = 10
 
 
 def parse_args() -> argparse.Namespace:
@@ -28,6 +38,11 @@ def parse_args() -> argparse.Namespace:
         ),
         allow_abbrev=False,
     )
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        help="Show the output of start-cluster.sh instead of discarding it.",
+    )
     parser.add_argument(
         "python_exec",
         help=(
@@ -43,254 +58,439 @@ def parse_args() -> argparse.Namespace:
     return parser.parse_args()
 
 
-def normalize_job_args(job_args: Sequence[str]) -> list[str]:
+def normalize_job_args(job_args: Sequence[str]) -> tuple[str, ...]:
     if job_args and job_args[0] == "--":
-        return list(job_args[1:])
-    return list(job_args)
+        return tuple(job_args[1:])
+    return tuple(job_args)
 
 
-def run_command(
+def report_error(*lines: str) -> None:
+    """Write a block of error lines to stderr with a single write and flush."""
+    sys.stderr.write("".join(f"{line}\n" for line in lines))
+    sys.stderr.flush()
+
+
+async def run_command_async(
     cmd: Sequence[str],
     *,
     cwd: Path,
-    capture_output: bool = False,
-    check: bool = True,
-) -> subprocess.CompletedProcess[str]:
-    result = subprocess.run(
-        list(cmd),
+    quiet: bool = False,
+) -> None:
+    """Run ``cmd`` to completion, raising RuntimeError on a non-zero exit."""
+    target = asyncio.subprocess.DEVNULL if quiet else None
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
         cwd=str(cwd),
-        text=True,
-        stdout=subprocess.PIPE if capture_output else None,
-        stderr=subprocess.STDOUT if capture_output else None,
+        stdout=target,
+        stderr=target,
     )
-    if check and result.returncode != 0:
-        if capture_output and result.stdout:
-            sys.stderr.write(result.stdout)
+    try:
+        returncode = await proc.wait()
+    except BaseException:
+        # Cancelled (Ctrl-C or SIGTERM): don't leave the child running behind us.
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        raise
+    if returncode != 0:
         raise RuntimeError(
-            f"Command {' '.join(cmd)} failed with exit code {result.returncode}"
+            f"Command {' '.join(cmd)} failed with exit code {returncode}"
         )
-    return result
 
 
-def extract_job_id(output: str) -> str | None:
-    match = JOB_ID_PATTERN.search(output)
-    return match.group(1) if match else None
+def find_missing_paths(paths: Sequence[tuple[str, Path]]) -> list[str]:
+    """Stat each labelled path once and describe every one that is missing."""
+    missing = []
+    for label, path in paths:
+        try:
+            path.stat()
+        except OSError:
+            missing.append(f"{label}: {path}")
+    return missing
+
+
+async def stream_command(
+    cmd: Sequence[str],
+    *,
+    cwd: Path,
+    sink: Callable[[bytes], object],
+    pattern: re.Pattern[bytes] | None = None,
+    env: dict[str, str] | None = None,
+) -> tuple[int, str | None]:
+    """Run ``cmd`` and hand each raw output line to ``sink`` as it arrives.
+
+    Returns the exit code and the first group of the first line matching
+    ``pattern``; lines after the match are passed through without scanning.
+    Output stays as bytes and only the matched group is decoded.
+    """
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        cwd=str(cwd),
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT,
+        env=env,
+    )
+    assert proc.stdout is not None
+    found: str | None = None
+    async for line in proc.stdout:
+        sink(line)
+        if pattern is not None and found is None:
+            match = pattern.search(line)
+            if match:
+                found = match.group(1).decode()
+    return await proc.wait(), found
+
+
+async def poll_until(
+    condition: Callable[[], bool],
+    *,
+    timeout: float,
+    interval: float,
+    max_interval: float | None = None,
+) -> bool:
+    """Call ``condition`` until it returns True or ``timeout`` seconds elapse.
+
+    ``condition`` runs in a worker thread so blocking HTTP checks do not stall
+    the event loop. The delay between attempts starts at ``interval`` and
+    doubles after each failed attempt up to ``max_interval`` (fixed when
+    ``max_interval`` is None).
+    """
+    deadline = time.monotonic() + timeout
+    delay = interval
+    while True:
+        if await asyncio.to_thread(condition):
+            return True
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        await asyncio.sleep(min(delay, remaining))
+        if max_interval is not None:
+            delay = min(delay * 2, max_interval)
+
+
+def rest_get(conn: http.client.HTTPConnection, path: str) -> tuple[int, bytes] | None:
+    """GET ``path`` over a kept-alive connection, returning status and body.
+
+    On any transport error the connection is closed so the next request
+    reconnects transparently. A failure on a reused socket (e.g. the server
+    dropped an idle keep-alive connection) is retried once on a fresh one.
+    """
+    while True:
+        reused = conn.sock is not None
+        try:
+            conn.request("GET", path)
+            response = conn.getresponse()
+            return response.status, response.read()
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            if not reused:
+                return None
+
+
+def check_cluster_ready(conn: http.client.HTTPConnection) -> bool:
+    """Return True once the REST API answers and a TaskManager has registered."""
+    result = rest_get(conn, "/overview")
+    if result is None or result[0] != 200:
+        return False
+    try:
+        overview = json_loads(result[1])
+    except ValueError:
+        return False
+    return overview.get("taskmanagers", 0) >= 1
 
 
-def check_job_status(job_id: str, target: str) -> str:
-    url = f"http://{target}/jobs/{job_id}"
+def get_job_details(job_id: str, conn: http.client.HTTPConnection) -> dict | None:
+    result = rest_get(conn, f"/jobs/{job_id}")
+    if result is None or result[0] != 200:
+        return None
     try:
-        with urlopen(url, timeout=5) as response:
-            payload = json.load(response)
-    except (HTTPError, URLError, json.JSONDecodeError, TimeoutError, ValueError):
+        return json_loads(result[1])
+    except ValueError:
+        return None
+
+
+def check_job_status(job_id: str, conn: http.client.HTTPConnection) -> str:
+    payload = get_job_details(job_id, conn)
+    if payload is None:
         return "UNKNOWN"
     return payload.get("state", "UNKNOWN")
 
 
-def main() -> int:
+def check_all_vertices_running(job_id: str, conn: http.client.HTTPConnection) -> bool:
+    """Return True once every vertex is RUNNING and has moved at least one record."""
+    payload = get_job_details(job_id, conn)
+    if payload is None:
+        return False
+    vertices = payload.get("vertices") or []
+    if not vertices:
+        return False
+    for vertex in vertices:
+        if vertex.get("status") != "RUNNING":
+            return False
+        metrics = vertex.get("metrics") or {}
+        if not (metrics.get("read-records") or metrics.get("write-records")):
+            return False
+    return True
+
+
+async def wait_for_job_running(
+    job_id: str, conn: http.client.HTTPConnection, timeout: float
+) -> str:
+    """Poll the job state with exponential backoff and return the last state seen.
+
+    Polling starts immediately after submission: a job the JobManager does not
+    know yet reports UNKNOWN and is simply retried.
+    """
+    started = time.monotonic()
+    job_status = "UNKNOWN"
+    last_status: str | None = None
+
+    def job_running() -> bool:
+        nonlocal job_status, last_status
+        job_status = check_job_status(job_id, conn)
+        if job_status != last_status:
+            waited = time.monotonic() - started
+            print(f"Job status: {job_status} (waited {waited:.1f}s)")
+            last_status = job_status
+        return job_status == "RUNNING"
+
+    await poll_until(job_running, timeout=timeout, interval=0.05, max_interval=0.5)
+    return job_status
+
+
+def find_largest_state_file(savepoint_path: Path) -> Path | None:
+    """Return the largest file in the savepoint directory, ignoring _metadata."""
+    target_file: Path | None = None
+    max_size = -1
+    with os.scandir(savepoint_path) as entries:
+        for entry in entries:
+            if entry.is_file(follow_symlinks=False) and entry.name != "_metadata":
+                try:
+                    size = entry.stat(follow_symlinks=False).st_size
+                except OSError:
+                    continue
+                if size > max_size:
+                    max_size = size
+                    target_file = Path(entry.path)
+    return target_file
+
+
+async def async_main() -> int:
+    # Turn SIGTERM into cancellation so cleanup in except/finally blocks runs.
+    asyncio.get_running_loop().add_signal_handler(
+        signal.SIGTERM, asyncio.current_task().cancel
+    )
     args = parse_args()
     job_args = normalize_job_args(args.job_args)
 
     python_exec = Path(args.python_exec).expanduser().resolve()
-    if not python_exec.exists():
-        print(f"Error: Python executable not found: {python_exec}", file=sys.stderr)
-        return 1
-
-    repo_root = Path(__file__).resolve().parent
+    repo_root = Path(__file__).absolute().parent
     job_py = repo_root / "job.py"
-    if not job_py.exists():
-        print(
-            f"Error: job.py not found at expected location: {job_py}", file=sys.stderr
-        )
-        return 1
-
     swap_tool = repo_root / "swap_sst_last5"
-    if not swap_tool.exists():
-        print(
-            f"Error: swap tool not found at expected location: {swap_tool}",
-            file=sys.stderr,
-        )
-        return 1
 
     flink_home = Path(os.environ.get("FLINK_HOME", "/opt/flink"))
     flink_bin_dir = flink_home / "bin"
     flink_cli = flink_bin_dir / "flink"
     start_cluster = flink_bin_dir / "start-cluster.sh"
 
-    if not start_cluster.exists():
-        print(f"Error: start-cluster.sh not found in {flink_bin_dir}", file=sys.stderr)
-        return 1
-    if not flink_cli.exists():
-        print(f"Error: flink CLI not found in {flink_bin_dir}", file=sys.stderr)
+    missing = find_missing_paths(
+        [
+            ("Python executable", python_exec),
+            ("job.py", job_py),
+            ("swap tool", swap_tool),
+            ("flink CLI", flink_cli),
+        ]
+    )
+    if missing:
+        report_error(
+            "Error: required paths not found:", *(f"  {line}" for line in missing)
+        )
         return 1
 
     flink_jobmanager_target = os.environ.get(
         "FLINK_JOBMANAGER_TARGET", "127.0.0.1:8081"
     )
+    rest_conn = http.client.HTTPConnection(flink_jobmanager_target, timeout=5)
 
-    print("Starting Flink cluster...")
-    run_command([str(start_cluster)], cwd=repo_root)
-
-    print("Waiting for cluster to be ready...")
-    time.sleep(5)
-
-    submit_cmd = [
-        "uv",
-        "run",
-        "--",
-        str(flink_cli),
-        "run",
-        "-m",
-        flink_jobmanager_target,
-        "-d",
-        "-py",
-        str(job_py),
-        "-pyexec",
-        str(python_exec),
-        *job_args,
-    ]
+    print("Starting Flink cluster and waiting for it to be ready...")
+    # start-cluster.sh is not stat'ed up front: a missing script surfaces as
+    # FileNotFoundError from the exec itself.
+    try:
+        _, cluster_ready = await asyncio.gather(
+            run_command_async(
+                [str(start_cluster)], cwd=repo_root, quiet=not args.verbose
+            ),
+            poll_until(
+                lambda: check_cluster_ready(rest_conn),
+                timeout=CLUSTER_READY_TIMEOUT,
+                interval=0.1,
+            ),
+        )
+    except FileNotFoundError:
+        report_error(f"Error: start-cluster.sh not found in {flink_bin_dir}")
+        return 1
+    except RuntimeError as exc:
+        error_lines = [f"Error: {exc}"]
+        if not args.verbose:
+            error_lines.append(
+                "Rerun with --verbose to see the start-cluster.sh output."
+            )
+        report_error(*error_lines)
+        return 1
+    if not cluster_ready:
+        report_error(
+            f"Error: Flink cluster not ready (REST endpoint up with a TaskManager) within {CLUSTER_READY_TIMEOUT} seconds"
+        )
+        return 1
 
-    print("Submitting job...")
-    submit_proc = run_command(
-        submit_cmd, cwd=repo_root, capture_output=True, check=False
+    flink_cli_s = str(flink_cli)
+    job_py_s = str(job_py)
+    python_exec_s = str(python_exec)
+    swap_tool_s = str(swap_tool)
+
+    # Stand in for `uv run`: expose the venv's bin directory on PATH and tell
+    # PyFlink which interpreter to use. Both come from the unresolved path,
+    # which still points into the venv; the resolved one may be the base Python.
+    venv_python = Path(args.python_exec).expanduser().absolute()
+    flink_env = os.environ | {
+        "PATH": f"{venv_python.parent}{os.pathsep}{os.environ.get('PATH', '')}",
+        "PYFLINK_PYTHON": str(venv_python),
+    }
+
+    # Submit and resume share everything but the options in the middle.
+    cmd_prefix = (flink_cli_s, "run")
+    cmd_suffix = ("-py", job_py_s, "-pyexec", python_exec_s) + job_args
+    submit_cmd = cmd_prefix + ("-m", flink_jobmanager_target, "-d") + cmd_suffix
+
+    print("Submitting job...", flush=True)
+    submit_returncode, job_id = await stream_command(
+        submit_cmd,
+        cwd=repo_root,
+        sink=sys.stdout.buffer.write,
+        pattern=JOB_ID_PATTERN,
+        env=flink_env,
     )
-    job_output = submit_proc.stdout or ""
-    if job_output:
-        print(job_output, end="" if job_output.endswith("\n") else "\n")
-    if submit_proc.returncode != 0:
-        print("Error: Job submission failed", file=sys.stderr)
-        return submit_proc.returncode or 1
-
-    job_id = extract_job_id(job_output)
+    if submit_returncode != 0:
+        report_error("Error: Job submission failed")
+        return submit_returncode or 1
+
     print(f"DEBUG: Extracted Job ID: '{job_id or ''}'")
     if not job_id:
-        print("Error: Could not extract job ID from output", file=sys.stderr)
+        report_error("Error: Could not extract job ID from output")
         return 1
 
-    time.sleep(4)
-
     print("Checking job status and waiting for full initialization...")
-    max_wait = 30
-    wait_time = 0
-    job_status = "UNKNOWN"
-    while wait_time < max_wait:
-        job_status = check_job_status(job_id, flink_jobmanager_target)
-        print(f"Job status: {job_status} (waited {wait_time}s)")
-        if job_status == "RUNNING":
+    max_wait = JOB_RUNNING_TIMEOUT
+    job_status = await wait_for_job_running(job_id, rest_conn, max_wait)
+    if job_status == "RUNNING":
+        print("Job is running, waiting for all tasks to initialize...")
+        if not await poll_until(
+            lambda: check_all_vertices_running(job_id, rest_conn),
+            timeout=TASK_INIT_TIMEOUT,
+            interval=0.25,
+        ):
             print(
-                "Job is running, waiting additional 10 seconds for task initialization..."
+                f"Tasks not fully initialized after {TASK_INIT_TIMEOUT} seconds, continuing anyway"
             )
-            time.sleep(10)
-            break
-        time.sleep(2)
-        wait_time += 2
+
+    rest_conn.close()
 
     if job_status != "RUNNING":
-        print(
-            f"Error: Job failed to reach RUNNING state within {max_wait} seconds. Current status: {job_status}",
-            file=sys.stderr,
+        report_error(
+            f"Error: Job failed to reach RUNNING state within {max_wait} seconds. Current status: {job_status}"
         )
         return 1
 
     print("Stopping job and creating savepoint...")
     savepoint_cmd = [
-        str(flink_cli),
+        flink_cli_s,
         "savepoint",
         job_id,
         "--type",
         "native",
     ]
-    savepoint_proc = run_command(
-        savepoint_cmd, cwd=repo_root, capture_output=True, check=False
+    savepoint_lines: list[bytes] = []
+    savepoint_returncode, savepoint_location = await stream_command(
+        savepoint_cmd,
+        cwd=repo_root,
+        sink=savepoint_lines.append,
+        pattern=SAVEPOINT_PATH_PATTERN,
     )
-    savepoint_output = savepoint_proc.stdout or ""
-    if savepoint_proc.returncode != 0:
-        if savepoint_output:
-            sys.stderr.write(savepoint_output)
-        print("Error: Savepoint creation command failed", file=sys.stderr)
-        return savepoint_proc.returncode or 1
+    if savepoint_returncode != 0:
+        savepoint_output = b"".join(savepoint_lines).decode(errors="replace")
+        report_error(
+            *savepoint_output.splitlines(), "Error: Savepoint creation command failed"
+        )
+        return savepoint_returncode or 1
 
-    match = re.search(r"Path: file:(\S+)", savepoint_output)
-    if not match:
-        print("Error: Could not find savepoint path", file=sys.stderr)
+    if not savepoint_location:
+        savepoint_output = b"".join(savepoint_lines).decode(errors="replace")
+        error_lines = ["Error: Could not find savepoint path"]
         if savepoint_output:
-            print("Full output was:", file=sys.stderr)
-            sys.stderr.write(savepoint_output)
+            error_lines.append("Full output was:")
+            error_lines.extend(savepoint_output.splitlines())
+        report_error(*error_lines)
         return 1
 
-    savepoint_path = Path(match.group(1))
+    savepoint_path = Path(savepoint_location)
+    savepoint_path_s = str(savepoint_path)
     print(f"Savepoint created at: {savepoint_path}")
 
     if not savepoint_path.exists():
-        print(
-            f"Error: Savepoint path does not exist: {savepoint_path}", file=sys.stderr
-        )
+        report_error(f"Error: Savepoint path does not exist: {savepoint_path}")
         return 1
 
-    target_file: Path | None = None
-    max_size = -1
-    for candidate in savepoint_path.iterdir():
-        if candidate.is_file() and candidate.name != "_metadata":
-            try:
-                size = candidate.stat().st_size
-            except OSError:
-                continue
-            if size > max_size:
-                max_size = size
-                target_file = candidate
-
+    target_file = find_largest_state_file(savepoint_path)
     if target_file is None:
-        print("Error: No state file found in savepoint", file=sys.stderr)
+        report_error("Error: No state file found in savepoint")
         return 1
 
     print(f"Found state file: {target_file}")
 
-    target_file_with_suffix = target_file.with_name(f"{target_file.name}.sst")
-    target_file.rename(target_file_with_suffix)
+    target_file_with_suffix = f"{target_file}.sst"
+    # The swap tool rewrites its input via a temp file and rename, so it ends
+    # up on a new inode behind the .sst link; moving the link back over the
+    # original publishes that result, while a failure leaves the original alone.
+    # A .sst left behind by an earlier interrupted run is replaced, as the old
+    # rename-based flow did.
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(target_file_with_suffix)
+    os.link(target_file, target_file_with_suffix)
 
     try:
-        run_command([str(swap_tool), str(target_file_with_suffix)], cwd=repo_root)
-    except RuntimeError as exc:
-        print(str(exc), file=sys.stderr)
-        # Attempt to revert rename before exiting
-        if target_file_with_suffix.exists():
-            target_file_with_suffix.rename(target_file)
+        await run_command_async([swap_tool_s, target_file_with_suffix], cwd=repo_root)
+    except BaseException as exc:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(target_file_with_suffix)
+        if not isinstance(exc, RuntimeError):
+            raise
+        report_error(str(exc))
         return 1
 
-    target_file_with_suffix.rename(target_file)
-
-    print("Resuming job from modified savepoint...")
-    resume_cmd = [
-        "uv",
-        "run",
-        "--",
-        str(flink_cli),
-        "run",
-        "-s",
-        str(savepoint_path),
-        "-py",
-        str(job_py),
-        "-pyexec",
-        str(python_exec),
-        *job_args,
-    ]
-    resume_proc = run_command(
-        resume_cmd, cwd=repo_root, capture_output=True, check=False
+    os.replace(target_file_with_suffix, target_file)
+
+    print("Resuming job from modified savepoint...", flush=True)
+    resume_cmd = cmd_prefix + ("-s", savepoint_path_s) + cmd_suffix
+    resume_returncode, _ = await stream_command(
+        resume_cmd, cwd=repo_root, sink=sys.stdout.buffer.write, env=flink_env
     )
-    resume_output = resume_proc.stdout or ""
-    if resume_output:
-        print(resume_output, end="" if resume_output.endswith("\n") else "\n")
-    if resume_proc.returncode != 0:
-        print("Error: Failed to resume job from savepoint", file=sys.stderr)
-        return resume_proc.returncode or 1
+    if resume_returncode != 0:
+        report_error("Error: Failed to resume job from savepoint")
+        return resume_returncode or 1
 
     print(f"Flink logs location: {flink_home / 'log'}")
     print("To view logs: docker run -v $(pwd)/logs:/opt/flink/log flink-wal-test")
     return 0
 
 
+def main() -> int:
+    return asyncio.run(async_main())
+
+
 if __name__ == "__main__":
     try:
         sys.exit(main())
     except KeyboardInterrupt:
         sys.exit(130)
+    except asyncio.CancelledError:
+        sys.exit(128 + signal.SIGTERM)